@@ -1,7 +1,10 @@
-from fastapi import FastAPI, Request, HTTPException
-import requests, os, json, datetime
+from fastapi import FastAPI, Request, HTTPException, Response
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, field_validator
+import httpx, os, datetime, asyncio, time
+import aiofiles, orjson
 from dotenv import load_dotenv
-from typing import Optional, Dict
+from typing import Optional, Dict, Tuple, Any
+from collections import OrderedDict, defaultdict
 
 load_dotenv()
 app = FastAPI()
@@ -10,9 +13,33 @@ API_KEY     = os.getenv("CC_API_KEY")
 IDENTIFIER  = os.getenv("CC_IDENTIFIER")
 PASSWORD    = os.getenv("CC_PASSWORD")
 BASE_URL    = os.getenv("CC_BASE_URL", "https://api-capital.com")
+SESSION_URL   = f"{BASE_URL}/api/v1/session"
+POSITIONS_URL = f"{BASE_URL}/api/v1/positions"
+PING_URL      = f"{BASE_URL}/api/v1/ping"
+# Opposite-direction "open" signals close the current position(s) and enter in the same request.
+FLIP_ON_REVERSAL = os.getenv("CC_FLIP_ON_REVERSAL", "").lower() in ("1", "true", "yes")
 
 CST = None
 XST = None
+AUTH_HEADERS: Optional[Dict[str, str]] = None        # rebuilt on every login
+AUTH_HEADERS_JSON: Optional[Dict[str, str]] = None
+_LOGIN_LOCK = asyncio.Lock()
+_AUTH_GEN = 0   # bumped on every successful login
+SESSION_KEEPALIVE_SECONDS = 8 * 60   # Capital.com drops sessions after 10 min without activity
+SESSION_IDLE_SECONDS = 10 * 60
+SESSION_REFRESH_MARGIN = 30   # re-login this long before the session would idle out
+_TOKEN_EXPIRES_AT = 0.0       # monotonic; pushed forward by every authenticated response
+
+# Seconds a positions snapshot is reused. Our own orders invalidate it immediately, so the TTL
+# only bounds how long a change made outside this process (manual close, stop-out) can go unseen.
+POS_CACHE_TTL = float(os.getenv("CC_POS_CACHE_TTL") or 1.5)
+_POS_CACHE = {"at": 0.0, "data": None, "inflight": None, "gen": 0}
+# dealId -> epic of every deal in the last successful fetch. Unlike _POS_CACHE it survives
+# invalidate_positions(): a deal never changes instrument, so the mapping can't go stale.
+_DEAL_EPICS: Dict[str, str] = {}
+
+client: Optional[httpx.AsyncClient] = None
+_EPIC_LOCKS: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)   # serializes webhooks per epic
 
 SYMBOL_EPIC_MAP = {
     "GOLD":       {"epic": "GOLD",       "size": 1.2},
@@ -30,68 +57,217 @@ SYMBOL_EPIC_MAP = {
     "PLTR":       {"epic": "PLTR", "size": 7}
 }
 
+_SYMBOL_TABLE = {k: (v["epic"], v["size"]) for k, v in SYMBOL_EPIC_MAP.items()}   # symbol -> (epic, size)
+_ENTRY_DIRECTION = {"buy": "BUY", "sell": "SELL"}
+_CLOSE_DIRECTION = {"BUY": "SELL", "SELL": "BUY"}   # position direction -> direction that reduces it
+_ORDER_TEMPLATES = {   # (epic, direction, force_open) -> static order fields; only size (and stop) vary
+    (v["epic"], d, fo): {"epic": v["epic"], "direction": d, "orderType": "MARKET", "forceOpen": fo, "guaranteedStop": False}
+    for v in SYMBOL_EPIC_MAP.values() for d in ("BUY", "SELL") for fo in (True, False)
+}
+
 IDEMP_STORE = "processed_signals.json"
+IDEMP_LOG = "processed_signals.log"   # append-only, folded into IDEMP_STORE on compaction
 IDEMP_TTL_DAYS = 2
+IDEMP_COMPACT_SECONDS = 600
+IDEMP_FLUSH_DELAY = 1.0   # seconds; new IDs within this window share one log append
+
+_IDEMP: "OrderedDict[str, float]" = OrderedDict()   # signal_id -> epoch seconds, oldest first
+_IDEMP_PENDING: list = []   # (signal_id, ts) not yet appended to IDEMP_LOG
+_IDEMP_DIRTY = asyncio.Event()
+_bg_tasks: list = []
+
+LOG_FILE = "webhook_log.txt"
+LOG_Q: "asyncio.Queue[Tuple[float, str]]" = asyncio.Queue(maxsize=10_000)
+_log_task: Optional[asyncio.Task] = None
+_LAST_TS = [0, ""]  # [epoch second, formatted timestamp]
 
 def log(msg: str):
-    ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    line = f"[{ts}] {msg}"
-    print(line)
+    # Request path only enqueues; formatting, stdout and file I/O happen in _log_writer.
+    if _log_task is not None and _log_task.done():
+        # Writer is gone (should not happen): fall back to the old synchronous path
+        # rather than queueing lines nobody will read.
+        text = _format_lines([(time.time(), msg)])
+        print(text, end="")
+        _append_log_file(text)
+        return
     try:
-        with open("webhook_log.txt", "a", encoding="utf-8") as f:
-            f.write(line + "\n")
+        LOG_Q.put_nowait((time.time(), msg))
+    except asyncio.QueueFull:
+        print(_format_lines([(time.time(), msg)]), end="")
+
+def _format_lines(items: list) -> str:
+    out = []
+    for ts, msg in items:
+        sec = int(ts)
+        if sec != _LAST_TS[0]:
+            _LAST_TS[:] = [sec, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(sec))]
+        out.append(f"[{_LAST_TS[1]}] {msg}\n")
+    return "".join(out)
+
+def _drain_log_queue(limit: int) -> list:
+    batch = []
+    while not LOG_Q.empty() and len(batch) < limit:
+        batch.append(LOG_Q.get_nowait())
+    return batch
+
+def _append_log_file(text: str):
+    try:
+        with open(LOG_FILE, "a", encoding="utf-8") as f:
+            f.write(text)
     except Exception as e:
         print(f"Error writing to log file: {e}")
 
-def login_to_capital():
-    global CST, XST
-    log("🔐 Logging in to Capital.com…")
-    r = requests.post(
-        f"{BASE_URL}/api/v1/session",
-        json={"identifier": IDENTIFIER, "password": PASSWORD},
-        headers={"X-CAP-API-KEY": API_KEY},
-        timeout=15
-    )
-    r.raise_for_status()
-    CST = r.headers.get("CST")
-    XST = r.headers.get("X-SECURITY-TOKEN")
-    if not CST or not XST:
-        raise RuntimeError("Login successful, but tokens not found in headers.")
-    log("✅ Login successful.")
-
-def capital_request(method: str, path: str, *, json_body=None, retry=True) -> requests.Response:
-    if not (CST and XST):
-        login_to_capital()
-    url = f"{BASE_URL}{path}"
-    headers = {"X-CAP-API-KEY": API_KEY, "CST": CST, "X-SECURITY-TOKEN": XST}
-    if json_body is not None:
-        headers["Content-Type"] = "application/json"
-
-    r = requests.request(method.upper(), url, headers=headers, json=json_body, timeout=20)
-
-    needs_relogin = (r.status_code == 401)
-    if not needs_relogin:
+async def _log_writer():
+    # Single consumer: keeps line order and batches writes off the request path.
+    f = None
+    held = ""   # batch taken off the queue but not yet in the file
+    try:
+        while True:
+            held = _format_lines([await LOG_Q.get()] + _drain_log_queue(255))
+            # stdout may be a pipe to journald/docker that blocks; keep it off the loop too.
+            # Its failures are independent of the file's: neither stops the other.
+            try:
+                await asyncio.to_thread(print, held, end="", flush=True)
+            except Exception:
+                pass
+            try:
+                if f is None:
+                    f = await aiofiles.open(LOG_FILE, "a", encoding="utf-8")
+                await f.write(held)
+                await f.flush()
+            except Exception as e:
+                # A failed batch (disk full, file moved) is reported and skipped; the next
+                # batch reopens the file, so logging resumes once the cause is gone.
+                print(f"Error writing to log file: {e}")
+                if f is not None:
+                    try: await f.close()
+                    except Exception: pass
+                    f = None
+            held = ""
+    except asyncio.CancelledError:
+        if held:   # cancelled mid-batch at shutdown: don't drop it
+            _append_log_file(held)
+        raise
+    finally:
+        if f is not None:
+            try: await f.close()
+            except Exception: pass
+
+def _flush_log_queue():
+    text = _format_lines(_drain_log_queue(LOG_Q.qsize()))
+    if not text: return
+    print(text, end="")
+    _append_log_file(text)
+
+async def login_to_capital(seen_gen: Optional[int] = None):
+    """Log in and rebuild the auth headers.
+
+    Callers that saw a failure with tokens of generation `seen_gen` pass it in; if another
+    coroutine has logged in since, the new tokens are reused instead of logging in again.
+    """
+    global CST, XST, AUTH_HEADERS, AUTH_HEADERS_JSON, _AUTH_GEN, _TOKEN_EXPIRES_AT
+    async with _LOGIN_LOCK:
+        if seen_gen is not None and seen_gen != _AUTH_GEN:
+            return
+        AUTH_HEADERS = AUTH_HEADERS_JSON = None
+        log("🔐 Logging in to Capital.com…")
+        r = await client.post(
+            SESSION_URL,
+            content=orjson.dumps({"identifier": IDENTIFIER, "password": PASSWORD}),
+            headers={"Content-Type": "application/json"}
+        )
+        r.raise_for_status()
+        CST = r.headers.get("CST")
+        XST = r.headers.get("X-SECURITY-TOKEN")
+        if not CST or not XST:
+            raise RuntimeError("Login successful, but tokens not found in headers.")
+        AUTH_HEADERS = {"CST": CST, "X-SECURITY-TOKEN": XST}
+        AUTH_HEADERS_JSON = {**AUTH_HEADERS, "Content-Type": "application/json"}
+        _AUTH_GEN += 1
+        _TOKEN_EXPIRES_AT = time.monotonic() + SESSION_IDLE_SECONDS
+        log("✅ Login successful.")
+
+def _json_or_none(r: httpx.Response) -> Any:
+    try:
+        return orjson.loads(r.content)
+    except orjson.JSONDecodeError:
+        return None
+
+def _session_expired(r: httpx.Response, j: Any) -> bool:
+    if r.status_code == 401:
+        return True
+    return isinstance(j, dict) and j.get("errorCode") in {
+        "error.invalid.session.token", "error.security.account.token.invalid"
+    }
+
+_RETRY_DELAYS = (0.15, 0.4)   # seconds between attempts
+_RETRY_STATUSES = {502, 503, 504}
+_IDEMPOTENT_METHODS = {"GET", "DELETE"}
+_UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+# Caps in-flight broker calls; a burst across many epics queues here instead of tripping rate limits.
+_OUTBOUND = asyncio.Semaphore(int(os.getenv("CC_MAX_INFLIGHT") or 8))
+
+async def _send(method: str, url: str, headers, content) -> httpx.Response:
+    # Orders (POST) are only retried if they provably never left the process,
+    # so a gateway error or read timeout can't turn into a duplicate position.
+    retry_transient = method in _IDEMPOTENT_METHODS
+    for attempt, delay in enumerate(_RETRY_DELAYS + (None,), 1):
         try:
-            j = r.json()
-            if isinstance(j, dict) and j.get("errorCode") in {
-                "error.invalid.session.token", "error.security.account.token.invalid"
-            }:
-                needs_relogin = True
-        except json.JSONDecodeError:
-            pass
-
-    if needs_relogin and retry:
+            async with _OUTBOUND:   # held per attempt, not across the retry sleep
+                r = await client.request(method, url, headers=headers, content=content)
+        except httpx.TransportError as e:
+            if delay is None or not (retry_transient or isinstance(e, _UNSENT_ERRORS)):
+                raise
+            log(f"⚠️ {method} {url} failed ({e!r}); retry {attempt}/{len(_RETRY_DELAYS)}")
+        else:
+            if delay is None or not retry_transient or r.status_code not in _RETRY_STATUSES:
+                return r
+            log(f"⚠️ {method} {url} returned {r.status_code}; retry {attempt}/{len(_RETRY_DELAYS)}")
+        await asyncio.sleep(delay)
+
+async def capital_request(method: str, url: str, *, json_body=None) -> Tuple[httpx.Response, Any]:
+    """Send an authenticated request; returns the response and its body decoded once (None if not JSON)."""
+    global _TOKEN_EXPIRES_AT
+    if AUTH_HEADERS is None or time.monotonic() >= _TOKEN_EXPIRES_AT - SESSION_REFRESH_MARGIN:
+        # Log in before the broker would reject the tokens; concurrent callers share one login.
+        await login_to_capital(_AUTH_GEN)
+    method = method.upper()
+    content = None if json_body is None else orjson.dumps(json_body)
+
+    relogged = False
+    while True:
+        gen = _AUTH_GEN
+        headers = AUTH_HEADERS if json_body is None else AUTH_HEADERS_JSON
+        r = await _send(method, url, headers, content)
+        j = _json_or_none(r)
+        if relogged or not _session_expired(r, j):
+            if gen == _AUTH_GEN and r.status_code < 400:
+                _TOKEN_EXPIRES_AT = time.monotonic() + SESSION_IDLE_SECONDS
+            return r, j
+
+        # Re-login (unless someone already did) and re-issue only this call, once.
         log("⚠️ Session invalid/expired → re-login and retry once.")
-        login_to_capital()
-        return capital_request(method, path, json_body=json_body, retry=False)
-    return r
+        await login_to_capital(gen)
+        relogged = True
 
-def get_open_positions() -> list:
-    r = capital_request("GET", "/api/v1/positions")
-    if r.status_code != 200:
+async def _token_refresher():
+    # Keep the session warm so webhooks don't pay for a 401 + re-login on the order path.
+    while True:
+        await asyncio.sleep(SESSION_KEEPALIVE_SECONDS)
+        try:
+            if AUTH_HEADERS is None:
+                await login_to_capital()
+            else:
+                await capital_request("GET", PING_URL)  # re-logs in if the session expired
+        except Exception as e:
+            log(f"⚠️ Session refresh failed: {e}")
+
+async def get_open_positions() -> Optional[list]:
+    r, j = await capital_request("GET", POSITIONS_URL)
+    if r.status_code != 200 or not isinstance(j, dict):
         log(f"❌ Fetch positions failed: {r.text}")
-        return []
-    return r.json().get("positions", [])
+        return None
+    return j.get("positions", [])
 
 def parse_pos(p: Dict) -> Dict:
     pos_data = p.get("position", {})
@@ -106,135 +282,383 @@ def parse_pos(p: Dict) -> Dict:
         "avg": float(avg) if (avg := p.get("level") or pos_data.get("level") or pos_data.get("openLevel")) else None
     }
 
-def find_position(epic: str) -> Optional[Dict]:
-    for p in get_open_positions():
-        pp = parse_pos(p)
-        if pp["epic"] == epic:
-            return pp
-    return None
+def _quick_epic(p: Dict) -> Optional[str]:
+    return p.get("epic") or (p.get("market") or {}).get("epic") or (p.get("position") or {}).get("epic")
+
+def _quick_deal_id(p: Dict) -> Optional[str]:
+    return p.get("dealId") or (p.get("position") or {}).get("dealId")
 
-def delete_position(deal_id: str) -> bool:
+async def _fetch_positions_by_epic(gen: int) -> Dict[str, list]:
+    # Index raw entries only; parse_pos runs later, and just for the epic a webhook asks for.
+    try:
+        positions = await get_open_positions()
+        if positions is None:
+            # Never pass a failed fetch off as "no positions": every webhook sharing this
+            # fetch would skip its close (and mark it processed) or open unchecked.
+            raise HTTPException(502, "Positions unavailable from broker")
+        by_epic: Dict[str, list] = {}
+        deal_epics = {}
+        for p in positions:
+            by_epic.setdefault(ep := _quick_epic(p), []).append(p)
+            deal_epics[_quick_deal_id(p)] = ep
+        # A full fetch is authoritative for open deals, so replace rather than merge.
+        _DEAL_EPICS.clear()
+        _DEAL_EPICS.update(deal_epics)
+        # Only cache fetches that no order has invalidated meanwhile.
+        if gen == _POS_CACHE["gen"]:
+            _POS_CACHE["at"], _POS_CACHE["data"] = time.monotonic(), by_epic
+        return by_epic
+    finally:
+        if gen == _POS_CACHE["gen"]:
+            _POS_CACHE["inflight"] = None
+
+def invalidate_positions():
+    _POS_CACHE["gen"] += 1
+    _POS_CACHE["data"] = _POS_CACHE["inflight"] = None
+
+async def get_open_positions_by_epic() -> Dict[str, list]:
+    if _POS_CACHE["data"] is not None and time.monotonic() - _POS_CACHE["at"] < POS_CACHE_TTL:
+        return _POS_CACHE["data"]
+    if _POS_CACHE["inflight"] is None:
+        # Single flight: concurrent callers await the same fetch.
+        _POS_CACHE["inflight"] = asyncio.create_task(_fetch_positions_by_epic(_POS_CACHE["gen"]))
+    return await asyncio.shield(_POS_CACHE["inflight"])
+
+async def find_positions(epic: str) -> list:
+    return [parse_pos(p) for p in (await get_open_positions_by_epic()).get(epic, ())]
+
+async def _delete_position(deal_id: str) -> Tuple[httpx.Response, Any]:
     log(f"🗑️ Deleting position {deal_id} via DELETE request.")
-    r = capital_request("DELETE", f"/api/v1/positions/{deal_id}")
+    try:
+        r, j = await capital_request("DELETE", POSITIONS_URL + "/" + deal_id)
+    finally:
+        invalidate_positions()
     if r.status_code in (200, 204):
         log("✅ Position deleted successfully.")
-        return True
-    log(f"⚠️ DELETE failed ({r.status_code}). Text: {r.text}")
-    return False
-
-def _load_ids() -> Dict[str, str]:
+    else:
+        log(f"⚠️ DELETE failed ({r.status_code}). Text: {r.text}")
+    return r, j
+
+def _deal_not_found(r: httpx.Response, j: Any) -> bool:
+    return r.status_code == 404 or (isinstance(j, dict) and str(j.get("errorCode", "")).startswith("error.not-found"))
+
+async def delete_position(deal_id: str) -> bool:
+    # DELETEs are retried on 5xx/read timeouts; if the first attempt went through, the retry
+    # answers not-found. The deal is closed either way, so that counts as success.
+    r, j = await _delete_position(deal_id)
+    return r.status_code in (200, 204) or _deal_not_found(r, j)
+
+async def _epic_of_deal(deal_id: str) -> Optional[str]:
+    # Deals opened since the last fetch aren't mapped yet; a lookup settles it either way.
+    if deal_id not in _DEAL_EPICS:
+        await get_open_positions_by_epic()
+    return _DEAL_EPICS.get(deal_id)
+
+def _idemp_cutoff() -> float:
+    # Same window as the original `(now - ts).days <= IDEMP_TTL_DAYS` check: .days rounds
+    # down, so an id was kept until just under IDEMP_TTL_DAYS + 1 days old.
+    return time.time() - (IDEMP_TTL_DAYS + 1) * 86400
+
+def _as_epoch(ts) -> float:
+    if isinstance(ts, str):  # stores written before the switch hold naive UTC ISO strings
+        return datetime.datetime.fromisoformat(ts).replace(tzinfo=datetime.timezone.utc).timestamp()
+    return float(ts)
+
+def _load_ids() -> "OrderedDict[str, float]":
     try:
-        with open(IDEMP_STORE, "r") as f: data = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError): data = {}
-    now = datetime.datetime.utcnow()
-    pruned = {k: iso for k, iso in data.items() if (now - datetime.datetime.fromisoformat(iso)).days <= IDEMP_TTL_DAYS}
-    if len(pruned) != len(data): _save_ids(pruned)
-    return pruned
-
-def _save_ids(data: Dict[str, str]):
-    with open(IDEMP_STORE, "w") as f: json.dump(data, f, indent=2)
+        with open(IDEMP_STORE, "rb") as f: data = orjson.loads(f.read())
+    except (FileNotFoundError, orjson.JSONDecodeError): data = {}
+    try:
+        with open(IDEMP_LOG, "rb") as f:
+            for line in f:
+                try: signal_id, ts = orjson.loads(line)
+                except ValueError: continue  # torn last line after a crash
+                data[signal_id] = ts
+    except FileNotFoundError: pass
+    cutoff = _idemp_cutoff()
+    ids = {k: _as_epoch(ts) for k, ts in data.items()}
+    return OrderedDict((k, ts) for k, ts in sorted(ids.items(), key=lambda kv: kv[1]) if ts > cutoff)
+
+def _save_ids(data: Dict[str, float]):
+    # Write compact JSON to a temp file and swap it in, so a crash never leaves a torn store.
+    tmp = IDEMP_STORE + ".tmp"
+    with open(tmp, "wb") as f: f.write(orjson.dumps(data))
+    os.replace(tmp, IDEMP_STORE)
+
+def _prune_ids(cutoff: float):
+    while _IDEMP and next(iter(_IDEMP.values())) <= cutoff:
+        _IDEMP.popitem(last=False)
+
+def _compact_ids():
+    # No await in here, so no mark_processed() can interleave between save and truncate.
+    _prune_ids(_idemp_cutoff())
+    _save_ids(_IDEMP)
+    open(IDEMP_LOG, "w").close()
+    _IDEMP_PENDING.clear()
+
+async def _idemp_compactor():
+    while True:
+        await asyncio.sleep(IDEMP_COMPACT_SECONDS)
+        try: _compact_ids()
+        except Exception as e: log(f"⚠️ Idempotency store compaction failed: {e}")
+
+async def _idemp_flusher():
+    while True:
+        await _IDEMP_DIRTY.wait()
+        await asyncio.sleep(IDEMP_FLUSH_DELAY)
+        _IDEMP_DIRTY.clear()
+        _prune_ids(_idemp_cutoff())
+        batch = _IDEMP_PENDING[:]
+        _IDEMP_PENDING.clear()
+        if not batch: continue
+        try:
+            async with aiofiles.open(IDEMP_LOG, "ab") as f:
+                await f.write(b"".join(orjson.dumps(entry) + b"\n" for entry in batch))
+        except Exception as e:
+            _IDEMP_PENDING[:0] = batch
+            _IDEMP_DIRTY.set()
+            log(f"⚠️ Could not persist {len(batch)} signal_id(s): {e}")
 
 def already_processed(signal_id: Optional[str]) -> bool:
-    return bool(signal_id) and signal_id in _load_ids()
+    return bool(signal_id) and signal_id in _IDEMP
 
 def mark_processed(signal_id: Optional[str]):
     if not signal_id: return
-    data = _load_ids()
-    data[signal_id] = datetime.datetime.utcnow().isoformat()
-    _save_ids(data)
-
-def place_order(epic: str, direction: str, size: float, *, force_open: bool, stop_level: Optional[float]=None):
-    payload = { "epic": epic, "direction": direction.upper(), "size": float(size), "orderType": "MARKET", "forceOpen": bool(force_open), "guaranteedStop": False }
+    ts = time.time()
+    _IDEMP[signal_id] = ts
+    _IDEMP.move_to_end(signal_id)
+    _IDEMP_PENDING.append((signal_id, ts))
+    _IDEMP_DIRTY.set()
+
+async def place_order(epic: str, direction: str, size: float, *, force_open: bool, stop_level: Optional[float]=None):
+    payload = {**_ORDER_TEMPLATES[(epic, direction, bool(force_open))], "size": float(size)}
     if stop_level is not None: payload["stopLevel"] = float(stop_level)
     log(f"📤 Sending order: {payload}")
-    r = capital_request("POST", "/api/v1/positions", json_body=payload)
+    try:
+        r, _ = await capital_request("POST", POSITIONS_URL, json_body=payload)
+    finally:
+        # Even a rejected or timed-out order may have changed positions broker-side.
+        invalidate_positions()
     return r
 
+# ===============================
+#   FASTAPI LIFECYCLE
+# ===============================
+@app.on_event("startup")
+async def on_startup():
+    global client, _log_task
+    _log_task = asyncio.create_task(_log_writer())
+    _IDEMP.update(_load_ids())
+    _compact_ids()
+    _bg_tasks.append(asyncio.create_task(_idemp_flusher()))
+    _bg_tasks.append(asyncio.create_task(_idemp_compactor()))
+    _bg_tasks.append(asyncio.create_task(_token_refresher()))
+    # Pool settings go on the transport: httpx ignores client-level limits/http2 once a transport is given.
+    client = httpx.AsyncClient(
+        headers={"X-CAP-API-KEY": API_KEY},
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            retries=3,  # retries failed connects only
+            limits=httpx.Limits(max_keepalive_connections=8, max_connections=16)
+        ),
+        timeout=httpx.Timeout(connect=5.0, read=20.0, write=5.0, pool=5.0)
+    )
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    for task in _bg_tasks:
+        task.cancel()
+    await asyncio.gather(*_bg_tasks, return_exceptions=True)
+    _bg_tasks.clear()
+    _compact_ids()
+    if client is not None:
+        await client.aclose()
+    if _log_task is not None:
+        _log_task.cancel()
+        try: await _log_task
+        except asyncio.CancelledError: pass
+    _flush_log_queue()
+
+# ===============================
+#   WEBHOOK PAYLOAD
+# ===============================
+class WebhookPayload(BaseModel):
+    # Numeric ids/symbols from alert templates are accepted as strings, as before.
+    model_config = ConfigDict(coerce_numbers_to_str=True)
+
+    symbol: Optional[str] = None
+    action: Optional[str] = None       # "buy" | "sell"
+    intent: Optional[str] = None       # "open" | "close" | "close_partial"
+    signal_id: Optional[str] = None
+    stop_loss: Optional[float] = None
+    size: Optional[float] = None       # KORREKTUR: ratio for close_partial, not 'close_percent'
+    # Optional for "close": closes just this deal. Its epic is checked against the symbol's first,
+    # from _DEAL_EPICS when known, otherwise via a positions lookup.
+    # It ends up in the DELETE path, so only plain id characters are accepted.
+    deal_id: Optional[str] = Field(None, pattern=r"^[A-Za-z0-9_-]+$")
+
+    @field_validator("action", "intent", mode="before")
+    @classmethod
+    def _lower(cls, v):
+        # Alert templates send "BUY"/"Close" as readily as "buy"/"close".
+        return v.lower() if isinstance(v, str) else v
+
+    @field_validator("size", mode="wrap")
+    @classmethod
+    def _lenient_size(cls, v, handler):
+        # An unusable size falls back to a full close instead of rejecting the signal.
+        try:
+            return handler(v)
+        except ValidationError:
+            log(f"⚠️ Invalid size for partial close ignored: {v}")
+            return None
+
+def _validation_detail(e: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(map(str, err['loc'])) or 'body'}: {err['msg']}" for err in e.errors())
+
 # ===============================
 #   FASTAPI WEBHOOK
 # ===============================
-@app.post("/webhook")
-async def handle_webhook(request: Request):
+def _failed_closes(positions: list, results: list) -> list:
+    """Deal ids whose DELETE (run via gather(return_exceptions=True)) did not succeed."""
+    failed = []
+    for pp, res in zip(positions, results):
+        if isinstance(res, Exception):
+            log(f"❌ DELETE for {pp['dealId']} raised: {res}")
+        if res is not True:
+            failed.append(pp["dealId"])
+    return failed
+
+async def handle_webhook(request: Request) -> Response:
+    # Registered as a plain Starlette route below: no dependency solving or response
+    # validation per call. HTTPExceptions still go through FastAPI's exception handler.
+    return Response(orjson.dumps(await _process_webhook(request)), media_type="application/json")
+
+async def _process_webhook(request: Request) -> dict:
     try:
-        data = await request.json()
-        log(f"📥 Received payload: {data}")
+        raw = await request.body()
+        # Log the bytes as received instead of repr()-ing the parsed dict.
+        log(f"📥 Received payload ({len(raw)} B): {raw.decode('utf-8', 'replace')}")
+        try:
+            payload = WebhookPayload.model_validate_json(raw)
+        except ValidationError as e:
+            raise HTTPException(422, f"Invalid payload: {_validation_detail(e)}")
 
-        symbol      = data.get("symbol")
-        action      = (data.get("action") or "").lower()      # "buy" | "sell"
-        intent      = (data.get("intent") or "").lower()      # "open" | "close" | "close_partial"
-        signal_id   = data.get("signal_id")
-        stop_loss   = data.get("stop_loss")
-        size_ratio_raw = data.get("size") # KORREKTUR: Lese das 'size' Feld, nicht 'close_percent'
+        symbol      = payload.symbol
+        action      = payload.action or ""
+        intent      = payload.intent or ""
+        signal_id   = payload.signal_id
 
         if not symbol or not intent:
             raise HTTPException(400, "Missing 'symbol' or 'intent'")
-        if symbol not in SYMBOL_EPIC_MAP:
+        if (symbol_entry := _SYMBOL_TABLE.get(symbol)) is None:
             raise HTTPException(400, f"Unknown symbol: {symbol}")
 
-        if already_processed(signal_id):
-            log(f"🧊 Duplicate signal ignored (signal_id={signal_id})")
-            return {"status": "duplicate_ignored", "signal_id": signal_id}
-
-        epic = SYMBOL_EPIC_MAP[symbol]["epic"]
-        pos  = find_position(epic)
-
-        # KORREKTUR: Fasse "close" und "close_partial" zusammen
-        if intent in ("close", "close_partial"):
-            if not pos:
-                log("ℹ️ No open position; nothing to close.")
-                mark_processed(signal_id)
-                return {"status": "no_position_to_close"}
-
-            # Prüfe, ob es ein Partial Close ist
-            is_partial = False
-            size_ratio = 0.0
-            if intent == "close_partial" and size_ratio_raw is not None:
-                try:
-                    # KORREKTUR: "size" ist ein Verhältnis (z.B. 0.5), kein Prozentsatz
-                    size_ratio = float(size_ratio_raw)
-                    is_partial = 0 < size_ratio < 1
-                except (TypeError, ValueError):
-                    log(f"⚠️ Invalid size for partial close ignored: {size_ratio_raw}")
-
-            if is_partial:
-                # KORREKTUR: Multipliziere direkt mit dem Verhältnis
-                size_to_close = round(pos["size"] * size_ratio, 8)
-                close_dir = "SELL" if pos["direction"] == "BUY" else "BUY"
-                r = place_order(epic, close_dir, size_to_close, force_open=False)
-                if r.status_code not in (200, 201):
-                    log(f"❌ Partial close order error: {r.text}")
-                    raise HTTPException(500, f"Partial close failed: {r.text}")
-                log(f"✅ Partial close executed for {size_ratio*100}% of position.")
-                mark_processed(signal_id)
-                return {"status": "partial_close_executed", "ratio": size_ratio, "size_closed": size_to_close}
+        epic, size = symbol_entry
+        # Same-epic signals run one at a time so a duplicate or open/close pair can't both act
+        # on the same positions snapshot; different epics still proceed concurrently.
+        async with _EPIC_LOCKS[epic]:
+            if already_processed(signal_id):
+                log(f"🧊 Duplicate signal ignored (signal_id={signal_id})")
+                return {"status": "duplicate_ignored", "signal_id": signal_id}
+
+            # KORREKTUR: Fasse "close" und "close_partial" zusammen
+            if intent in ("close", "close_partial"):
+                if intent == "close" and payload.deal_id:
+                    # Never DELETE a deal of another instrument: that would run outside its epic's lock.
+                    if (deal_epic := await _epic_of_deal(payload.deal_id)) is None:
+                        log(f"ℹ️ Deal {payload.deal_id} not open; nothing to close.")
+                        mark_processed(signal_id)
+                        return {"status": "no_position_to_close"}
+                    if deal_epic != epic:
+                        raise HTTPException(400, f"Deal {payload.deal_id} belongs to {deal_epic}, not {epic}")
+                    r, j = await _delete_position(payload.deal_id)
+                    if _deal_not_found(r, j):
+                        # Replayed close, or a deal closed elsewhere: nothing left to do.
+                        log(f"ℹ️ Deal {payload.deal_id} not open; nothing to close.")
+                        mark_processed(signal_id)
+                        return {"status": "no_position_to_close"}
+                    if r.status_code not in (200, 204):
+                        raise HTTPException(500, f"Full close via DELETE failed for: {payload.deal_id}")
+                    mark_processed(signal_id)
+                    return {"status": "position_closed", "deal_id": payload.deal_id}
+
+                positions = await find_positions(epic)
+                pos  = positions[0] if positions else None
+                if not pos:
+                    log("ℹ️ No open position; nothing to close.")
+                    mark_processed(signal_id)
+                    return {"status": "no_position_to_close"}
+
+                # Prüfe, ob es ein Partial Close ist
+                # KORREKTUR: "size" ist ein Verhältnis (z.B. 0.5), kein Prozentsatz
+                size_ratio = payload.size if intent == "close_partial" and payload.size is not None else 0.0
+                is_partial = 0 < size_ratio < 1
+
+                if is_partial:
+                    # KORREKTUR: Multipliziere direkt mit dem Verhältnis
+                    size_to_close = round(pos["size"] * size_ratio, 8)
+                    if (close_dir := _CLOSE_DIRECTION.get(pos["direction"])) is None:
+                        # Guessing here could send a same-direction order and grow the position.
+                        raise HTTPException(500, f"Unknown direction {pos['direction']!r} on position {pos['dealId']}")
+                    r = await place_order(epic, close_dir, size_to_close, force_open=False)
+                    if r.status_code not in (200, 201):
+                        log(f"❌ Partial close order error: {r.text}")
+                        raise HTTPException(500, f"Partial close failed: {r.text}")
+                    log(f"✅ Partial close executed for {size_ratio*100}% of position.")
+                    mark_processed(signal_id)
+                    return {"status": "partial_close_executed", "ratio": size_ratio, "size_closed": size_to_close}
             
-            # Wenn kein 'is_partial', handle es als Full Close
-            if not delete_position(pos["dealId"]):
-                raise HTTPException(500, "Full close via DELETE failed.")
-            mark_processed(signal_id)
-            return {"status": "positions_closed_fully"}
-
-        elif intent == "open":
-            if action not in ("buy", "sell"):
-                raise HTTPException(400, "For 'open' you must provide action 'buy' or 'sell'")
-            if pos:
-                log(f"ℹ️ Position already exists for {epic}. Ignoring open signal.")
+                # Wenn kein 'is_partial', handle es als Full Close (alle Positionen des Epics parallel)
+                results = await asyncio.gather(*(delete_position(pp["dealId"]) for pp in positions), return_exceptions=True)
+                failed = _failed_closes(positions, results)
+                if failed:
+                    raise HTTPException(500, f"Full close via DELETE failed for: {', '.join(failed)}")
                 mark_processed(signal_id)
-                return {"status": "ignored_position_exists"}
-
-            size = SYMBOL_EPIC_MAP[symbol]["size"]
-            r = place_order(epic, "BUY" if action == "buy" else "SELL", size, force_open=True, stop_level=float(stop_loss) if stop_loss is not None else None)
-            if r.status_code not in (200, 201):
-                log(f"❌ Entry order error: {r.text}")
-                raise HTTPException(500, f"Entry failed: {r.text}")
+                return {"status": "positions_closed_fully"}
+
+            elif intent == "open":
+                if (direction := _ENTRY_DIRECTION.get(action)) is None:
+                    raise HTTPException(400, "For 'open' you must provide action 'buy' or 'sell'")
+                # forceOpen orders are never rejected as duplicates by the broker, so this
+                # check can't be left to the POST; it runs only after the payload is validated.
+                positions = await find_positions(epic)
+                if positions and FLIP_ON_REVERSAL and all(_CLOSE_DIRECTION.get(pp["direction"]) == direction for pp in positions):
+                    # Reversal: close and re-enter concurrently instead of one round trip after the other.
+                    log(f"🔁 Reversing {epic} to {direction}.")
+                    *results, r = await asyncio.gather(
+                        *(delete_position(pp["dealId"]) for pp in positions),
+                        place_order(epic, direction, size, force_open=True, stop_level=payload.stop_loss),
+                        return_exceptions=True,
+                    )
+                    failed = _failed_closes(positions, results)
+                    if isinstance(r, Exception):
+                        raise r
+                    if r.status_code not in (200, 201):
+                        log(f"❌ Entry order error: {r.text}")
+                        raise HTTPException(500, f"Entry failed: {r.text}")
+                    mark_processed(signal_id)   # the entry is in; a replay must not open a second one
+                    if failed:
+                        raise HTTPException(500, f"Reversal entry executed, but DELETE failed for: {', '.join(failed)}")
+                    log("✅ Reversal executed.")
+                    return {"status": "position_reversed", "size": size, "direction": direction}
+                if positions:
+                    log(f"ℹ️ Position already exists for {epic}. Ignoring open signal.")
+                    mark_processed(signal_id)
+                    return {"status": "ignored_position_exists"}
+
+                r = await place_order(epic, direction, size, force_open=True, stop_level=payload.stop_loss)
+                if r.status_code not in (200, 201):
+                    log(f"❌ Entry order error: {r.text}")
+                    raise HTTPException(500, f"Entry failed: {r.text}")
 
-            mark_processed(signal_id)
-            log("✅ Entry order executed.")
-            return {"status": "entry_executed", "size": size, "direction": action.upper()}
+                mark_processed(signal_id)
+                log("✅ Entry order executed.")
+                return {"status": "entry_executed", "size": size, "direction": direction}
 
-        else:
-            log(f"⚠️ Unknown intent: {intent}. Ignoring.")
-            return {"status": "unknown_intent", "intent": intent}
+            else:
+                log(f"⚠️ Unknown intent: {intent}. Ignoring.")
+                return {"status": "unknown_intent", "intent": intent}
 
     except HTTPException as he:
         log(f"HTTP Exception: {he.status_code} - {he.detail}")
@@ -243,13 +667,17 @@ async def handle_webhook(request: Request):
         log(f"🔥 UNEXPECTED SERVER ERROR: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-
-
-
-
-
-
-
-
-
-
+app.add_route("/webhook", handle_webhook, methods=["POST"])
+
+if __name__ == "__main__":
+    import uvicorn
+    # loop="auto" picks uvloop when installed (it isn't on Windows); httptools is always required.
+    # Single worker on purpose: tokens, the position cache and the signal-id set are per process.
+    uvicorn.run(
+        app,
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        loop="auto",
+        http="httptools",
+        access_log=False,   # every webhook is already logged by log(); skip uvicorn's per-request line
+    )